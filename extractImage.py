@@ -1,117 +1,200 @@
 import fitz  # PyMuPDF
 import cv2
 import numpy as np
+import hashlib
 import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache, partial
+from scipy.sparse.csgraph import connected_components
 
 PDF_PATH = "2023Gauss7Contest.pdf"
 OUTPUT_DIR = "2023_extracted_diagrams"
+CACHE_DIR = "cache"
+DETECT_DPI = 150  # bounding boxes only need a coarse page
 
-os.makedirs(OUTPUT_DIR, exist_ok=True)
+KERNEL3 = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))  # 5x5 at 300 DPI
+png_params = [cv2.IMWRITE_PNG_COMPRESSION, 1]  # much faster deflate, slightly larger files
 
-doc = fitz.open(PDF_PATH)
+# Run threshold/morphology/Canny through the T-API (OpenCL) when a device exists.
+# Decided per worker in init_worker: an OpenCL context does not survive fork.
+USE_OPENCL = False
 
-diagram_count = 0
-padding_ratio = 0.18  # 15% extra on each side
-min_w, min_h = 80, 80  # allow slightly smaller diagrams
+# PNG encoding releases the GIL, so crops are written in the background
+io_pool = ThreadPoolExecutor(max_workers=4)
 
-def rect_area(r):
-    return r[2] * r[3]
+@dataclass
+class DetectionConfig:
+    """One set of detection knobs; every config runs on the same rendered page.
 
-def intersect_area(a, b):
-    x1 = max(a[0], b[0])
-    y1 = max(a[1], b[1])
-    x2 = min(a[0] + a[2], b[0] + b[2])
-    y2 = min(a[1] + a[3], b[1] + b[3])
-    w = max(0, x2 - x1)
-    h = max(0, y2 - y1)
-    return w * h
+    Pixel sizes are in DETECT_DPI pixels; ``dpi`` is the resolution of the
+    saved crops.
+    """
+    name: str
+    output_dir: str = ""  # defaults to "extracted_<name>"
+    dpi: int = 300
+    min_w: int = 40  # allow slightly smaller diagrams (80px at 300 DPI)
+    min_h: int = 40
+    padding_ratio: float = 0.18  # 18% extra on each side
+    threshold_method: str = "adaptive_mean"  # "global", "adaptive_mean" or "adaptive_gauss"
+    thresh_value: int | None = None  # used by "global"; None picks it per page with Otsu
+    block_size: int = 13  # used by the adaptive methods
+    c: int = 10
+    morphology: bool = True  # close small gaps in the threshold mask
 
-def merge_two(a, b):
-    x1 = min(a[0], b[0])
-    y1 = min(a[1], b[1])
-    x2 = max(a[0] + a[2], b[0] + b[2])
-    y2 = max(a[1] + a[3], b[1] + b[3])
-    return (x1, y1, x2 - x1, y2 - y1)
+    def __post_init__(self):
+        if not self.output_dir:
+            self.output_dir = f"extracted_{self.name}"
+
+CONFIGS = [DetectionConfig("2023", output_dir=OUTPUT_DIR)]
 
 def merge_rects(rects, iou_thresh=0.1):
+    """Union boxes whose IoU exceeds ``iou_thresh``, repeating until stable.
+
+    Pairwise IoU is computed with NumPy broadcasting and the overlap graph is
+    split into connected components; each component becomes its bounding box.
+    """
     if not rects:
         return []
-    merged = True
-    while merged:
-        merged = False
-        used = [False] * len(rects)
-        new_rects = []
-        for i in range(len(rects)):
-            if used[i]:
-                continue
-            a = rects[i]
-            for j in range(i + 1, len(rects)):
-                if used[j]:
-                    continue
-                b = rects[j]
-                inter = intersect_area(a, b)
-                if inter > 0:
-                    union_area = rect_area(a) + rect_area(b) - inter
-                    iou = inter / union_area if union_area > 0 else 0
-                    if iou > iou_thresh:
-                        a = merge_two(a, b)
-                        used[j] = True
-                        merged = True
-            used[i] = True
-            new_rects.append(a)
-        rects = new_rects
-    return rects
-
-for page_num in range(len(doc)):
-    # Skip first page entirely (instructions page)
-    if page_num == 0:
-        continue
+    r = np.asarray(rects, dtype=np.int64)
+    x1, y1 = r[:, 0], r[:, 1]
+    x2, y2 = x1 + r[:, 2], y1 + r[:, 3]
+    while True:
+        iw = np.clip(np.minimum(x2[:, None], x2) - np.maximum(x1[:, None], x1), 0, None)
+        ih = np.clip(np.minimum(y2[:, None], y2) - np.maximum(y1[:, None], y1), 0, None)
+        inter = iw * ih
+        area = (x2 - x1) * (y2 - y1)
+        iou = inter / (area[:, None] + area - inter + 1e-9)
+        n, labels = connected_components(iou > iou_thresh, directed=False)
+        if n == len(x1):
+            break
+        nx1 = np.full(n, np.iinfo(np.int64).max)
+        ny1 = np.full(n, np.iinfo(np.int64).max)
+        nx2 = np.zeros(n, dtype=np.int64)
+        ny2 = np.zeros(n, dtype=np.int64)
+        np.minimum.at(nx1, labels, x1)
+        np.minimum.at(ny1, labels, y1)
+        np.maximum.at(nx2, labels, x2)
+        np.maximum.at(ny2, labels, y2)
+        x1, y1, x2, y2 = nx1, ny1, nx2, ny2
+    return [(int(a), int(b), int(c - a), int(d - b)) for a, b, c, d in zip(x1, y1, x2, y2)]
 
-    page = doc[page_num]
+def drop_contained(rects):
+    """Drop boxes that lie entirely inside another box (one broadcast compare)."""
+    if len(rects) < 2:
+        return rects
+    r = np.asarray(rects, dtype=np.int32)
+    x1, y1 = r[:, 0], r[:, 1]
+    x2, y2 = x1 + r[:, 2], y1 + r[:, 3]
+    # inside[i, j]: box i lies within box j
+    inside = (x1[:, None] >= x1) & (y1[:, None] >= y1) & (x2[:, None] <= x2) & (y2[:, None] <= y2)
+    np.fill_diagonal(inside, False)
+    # of two identical boxes, keep the first one
+    identical = inside & inside.T
+    inside &= ~identical | np.tri(len(r), k=-1, dtype=bool)
+    return [tuple(int(v) for v in b) for b in r[~inside.any(axis=1)]]
 
-    # Render page at 300 DPI
-    zoom = 300 / 72
-    mat = fitz.Matrix(zoom, zoom)
-    pix = page.get_pixmap(matrix=mat, alpha=False)
+@lru_cache(maxsize=1)
+def open_doc(pdf_path):
+    """Open ``pdf_path`` once per process; workers reuse it for every page they get."""
+    # fitz documents cannot be pickled, so each worker opens its own
+    return fitz.open(pdf_path, filetype="pdf")
 
-    # Make image array
-    img = np.frombuffer(pix.samples, dtype=np.uint8)
-    # reshape depends on number of channels
-    img = img.reshape(pix.height, pix.width, pix.n)
-    if pix.n == 4:  # RGBA -> RGB
-        img = cv2.cvtColor(img, cv2.COLOR_RGBA2RGB)
-    elif pix.n == 1:
-        img = cv2.cvtColor(img, cv2.COLOR_GRAY2RGB)
+def pix_array(pix):
+    """View a pixmap's samples as a uint8 array without copying them.
 
-    if page_num == 1:
-        top = int(0.10 * img.shape[0])
-        img = img[top:, :, :]  # drop the top 10%
+    Uses the zero-copy ``samples_mv`` where PyMuPDF provides it; the view is
+    only valid while ``pix`` is alive.
+    """
+    samples = getattr(pix, "samples_mv", None)
+    if samples is None:  # older PyMuPDF
+        samples = pix.samples
+    shape = (pix.height, pix.width) if pix.n == 1 else (pix.height, pix.width, pix.n)
+    return np.frombuffer(samples, dtype=np.uint8).reshape(shape)
 
-    gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
-    h_img, w_img = gray.shape
+def load_page(doc, page_num, dpi):
+    """Return page ``page_num`` as a grayscale array, rendering it only if not cached.
 
-    # --- Method A: adaptive threshold + morphological closing (good for filled shapes) ---
-    th_adapt = cv2.adaptiveThreshold(
-        gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 25, 10
+    Pages are cached as .npy files in CACHE_DIR, keyed by the PDF's full path
+    and size; a cache entry older than the PDF is rendered again.
+    """
+    st = os.stat(doc.name)
+    stem = os.path.splitext(os.path.basename(doc.name))[0]
+    # Same-named PDFs in different folders must not share entries
+    key = hashlib.blake2b(f"{os.path.abspath(doc.name)}:{st.st_size}".encode(), digest_size=4).hexdigest()
+    path = os.path.join(CACHE_DIR, f"{stem}_{key}_page{page_num+1}_{dpi}_gray.npy")
+    if os.path.exists(path) and os.path.getmtime(path) >= st.st_mtime:
+        return np.load(path)
+
+    zoom = dpi / 72
+    # MuPDF converts to gray while rasterizing, so no separate RGB -> GRAY pass
+    pix = doc[page_num].get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False, colorspace=fitz.csGRAY)
+    gray = pix_array(pix)
+    # Write next to the entry and rename it into place, so an interrupted run
+    # never leaves a truncated .npy that looks newer than the PDF
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            np.save(f, gray)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return gray.copy()  # the view would not outlive pix
+
+def component_boxes(mask):
+    """Return the (x, y, w, h) box of every foreground blob in ``mask`` as an (N, 4) array."""
+    if isinstance(mask, cv2.UMat):
+        mask = mask.get()  # labelling has no OpenCL path
+    _, _, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    return stats[1:, :4]  # row 0 is the background
+
+def threshold(gray, config):
+    """Binarize ``gray`` (ink nonzero) with the method selected by ``config``."""
+    if config.threshold_method == "global":
+        if config.thresh_value is None:
+            # Otsu's histogram search runs inside OpenCV and adapts to faint scans
+            _, mask = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+        elif isinstance(gray, cv2.UMat):
+            _, mask = cv2.threshold(gray, config.thresh_value, 255, cv2.THRESH_BINARY_INV)
+        else:
+            # Labelling only needs nonzero ink, so a 0/1 compare skips the x255 scaling
+            mask = np.less_equal(gray, config.thresh_value).view(np.uint8)
+        return mask
+    if config.threshold_method == "adaptive_mean":
+        method = cv2.ADAPTIVE_THRESH_MEAN_C
+    elif config.threshold_method == "adaptive_gauss":
+        method = cv2.ADAPTIVE_THRESH_GAUSSIAN_C
+    else:
+        raise ValueError(f"unknown threshold_method: {config.threshold_method!r}")
+    return cv2.adaptiveThreshold(
+        gray, 255, method, cv2.THRESH_BINARY_INV, config.block_size, config.c
     )
-    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (5, 5))
-    closed = cv2.morphologyEx(th_adapt, cv2.MORPH_CLOSE, kernel, iterations=2)
-    contours_a, _ = cv2.findContours(closed, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+def detect(gray, page_num, config):
+    """Return the diagram bounding boxes (x, y, w, h) found in a grayscale page."""
+    h_img, w_img = gray.shape
+    src = cv2.UMat(gray) if USE_OPENCL else gray
+
+    # --- Method A: threshold + morphological closing (good for filled shapes) ---
+    mask = threshold(src, config)
+    if config.morphology:
+        mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, KERNEL3, iterations=2)
+    boxes_a = component_boxes(mask)
 
     # --- Method B: Canny edges + dilation (good for outlines / faint circles) ---
-    edges = cv2.Canny(gray, 50, 150)
-    edges = cv2.dilate(edges, kernel, iterations=2)
-    contours_b, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    edges = cv2.Canny(src, 50, 150)
+    edges = cv2.dilate(edges, KERNEL3, iterations=2)
+    boxes_b = component_boxes(edges)
 
     # Collect bounding boxes from both methods
-    boxes = []
-    for cnt in contours_a + contours_b:
-        x, y, w, h = cv2.boundingRect(cnt)
-        if w >= min_w and h >= min_h:
-            boxes.append((x, y, w, h))
+    all_boxes = np.vstack([boxes_a, boxes_b])
+    w_all, h_all = all_boxes[:, 2], all_boxes[:, 3]
+    boxes = all_boxes[(w_all >= config.min_w) & (h_all >= config.min_h)].tolist()
 
     # Merge overlapping / near-duplicate boxes
-    boxes = merge_rects(boxes, iou_thresh=0.08)
+    boxes = merge_rects(drop_contained(boxes), iou_thresh=0.08)
 
     # If this is page 2, we avoided the previous hard top-crop.
     # But we still want to ignore header-like regions (wide, short regions spanning most of page width)
@@ -127,33 +210,88 @@ for page_num in range(len(doc)):
 
     # If nothing found (robust fallback): try relaxed detection (lower min size)
     if not final_boxes:
-        fallback_min = 50
-        boxset = []
-        for cnt in contours_a + contours_b:
-            x, y, w, h = cv2.boundingRect(cnt)
-            if w >= fallback_min and h >= fallback_min:
-                boxset.append((x, y, w, h))
-        boxset = merge_rects(boxset, iou_thresh=0.05)
+        fallback_min = 25
+        boxset = all_boxes[(w_all >= fallback_min) & (h_all >= fallback_min)].tolist()
+        boxset = merge_rects(drop_contained(boxset), iou_thresh=0.05)
         # apply same header heuristic
         for (x, y, w, h) in boxset:
             if page_num == 1 and y < cutoff and w > 0.85 * w_img and h < 0.25 * h_img:
                 continue
             final_boxes.append((x, y, w, h))
 
-    # Save crops with relative padding
-    for i, (x, y, w, h) in enumerate(final_boxes, start=1):
-        pad_w = int(w * padding_ratio)
-        pad_h = int(h * padding_ratio)
+    return final_boxes
+
+def init_worker():
+    global USE_OPENCL
+    # One page per process already fills every core; keep OpenCV single-threaded
+    cv2.setNumThreads(1)
+    # Probing initializes the OpenCL runtime, so only do it after the fork
+    USE_OPENCL = cv2.ocl.haveOpenCL()
+    cv2.ocl.setUseOpenCL(USE_OPENCL)
+
+def process_page(pdf_path, page_num, configs):
+    """Detect and save the diagrams of one page for every config.
+
+    The page is rendered (or loaded from the cache) once and shared by all
+    configs; returns the number of diagrams saved per config.
+    """
+    # Skip first page entirely (instructions page)
+    if page_num == 0:
+        return [0] * len(configs)
+
+    doc = open_doc(pdf_path)
+    page = doc[page_num]
+    gray = load_page(doc, page_num, DETECT_DPI)
+
+    top = 0
+    if page_num == 1:
+        top = int(0.10 * gray.shape[0])
+        gray = gray[top:, :]  # drop the top 10%
+
+    h_img, w_img = gray.shape
+    to_pt = 72 / DETECT_DPI
+
+    counts = []
+    for config in configs:
+        crop_zoom = config.dpi / 72
+
+        # Save crops with relative padding
+        writes = []
+        for i, (x, y, w, h) in enumerate(detect(gray, page_num, config), start=1):
+            pad_w = int(w * config.padding_ratio)
+            pad_h = int(h * config.padding_ratio)
+
+            x1 = max(x - pad_w, 0)
+            y1 = max(y - pad_h, 0)
+            x2 = min(x + w + pad_w, w_img)
+            y2 = min(y + h + pad_h, h_img)
+
+            # Rasterize only the padded box, at crop resolution
+            clip = fitz.Rect(x1 * to_pt, (y1 + top) * to_pt, x2 * to_pt, (y2 + top) * to_pt)
+            pix = page.get_pixmap(matrix=fitz.Matrix(crop_zoom, crop_zoom), clip=clip, alpha=False)
+
+            crop = cv2.cvtColor(pix_array(pix), cv2.COLOR_RGB2BGR)  # new array, safe to hand off
+
+            out_path = os.path.join(config.output_dir, f"page{page_num+1}_diagram{i}.png")
+            writes.append(io_pool.submit(cv2.imwrite, out_path, crop, png_params))
+
+        # Encoding overlaps the next crop's render; wait so the count is accurate
+        counts.append(sum(1 for f in writes if f.result()))
+    return counts
 
-        x1 = max(x - pad_w, 0)
-        y1 = max(y - pad_h, 0)
-        x2 = min(x + w + pad_w, w_img)
-        y2 = min(y + h + pad_h, h_img)
+def main(configs):
+    for config in configs:
+        os.makedirs(config.output_dir, exist_ok=True)
+    os.makedirs(CACHE_DIR, exist_ok=True)
 
-        crop = img[y1:y2, x1:x2]
+    # Not open_doc: forked workers must not share the parent's file handle
+    with fitz.open(PDF_PATH, filetype="pdf") as doc:
+        page_count = len(doc)
+    with ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=init_worker) as ex:
+        per_page = list(ex.map(partial(process_page, PDF_PATH, configs=configs), range(page_count)))
 
-        out_path = os.path.join(OUTPUT_DIR, f"page{page_num+1}_diagram{i}.png")
-        cv2.imwrite(out_path, crop)
-        diagram_count += 1
+    for config, counts in zip(configs, zip(*per_page)):
+        print(f"✅ Extracted {sum(counts)} diagrams into '{config.output_dir}' (smart header filtering, padding={int(config.padding_ratio*100)}%)")
 
-print(f"✅ Extracted {diagram_count} diagrams into '{OUTPUT_DIR}' (smart header filtering, padding={int(padding_ratio*100)}%)")
+if __name__ == "__main__":
+    main(CONFIGS)
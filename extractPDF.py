@@ -1,16 +1,38 @@
 import fitz  # PyMuPDF
+import bisect
 import os
-from PIL import Image
 import io
+import re
+from concurrent.futures import ThreadPoolExecutor
 
 PDF_PATH = "2025Gauss8Contest.pdf"
 OUTPUT_TEX = "gauss8_extracted.tex"
 IMG_DIR = "latex_images"
+PROBLEM_RE = re.compile(r"^\s*(\d{1,2})\b")  # "12. ...", "7 ..." but not "2024 ..."
+TEXT_FLAGS = fitz.TEXTFLAGS_DICT & ~fitz.TEXT_PRESERVE_IMAGES
+PNG_MODES = ("1", "L", "LA", "I", "P", "RGB", "RGBA")  # Pillow modes PNG can store
 
 # Create image folder
 os.makedirs(IMG_DIR, exist_ok=True)
 
-doc = fitz.open(PDF_PATH)
+def save_image(img_filename, image_bytes, transcode):
+    """Write one extracted image; ``transcode`` re-encodes it as PNG with Pillow."""
+    if transcode:
+        from PIL import Image  # only needed for the rare non-png/jpeg stream
+        img = Image.open(io.BytesIO(image_bytes))
+        if img.mode not in PNG_MODES:  # e.g. CMYK or LAB from a JPX stream
+            img = img.convert("RGB")
+        img.save(img_filename, "PNG")
+    else:
+        with open(img_filename, "wb") as out:
+            out.write(image_bytes)
+
+# PyMuPDF must stay on this thread, but file writes and Pillow transcodes
+# release the GIL, so they overlap with extraction of the next image
+io_pool = ThreadPoolExecutor(max_workers=os.cpu_count())
+writes = []
+
+doc = fitz.open(PDF_PATH, filetype="pdf")
 
 problems = []
 problem_number = 0
@@ -18,33 +40,53 @@ problem_number = 0
 # Process all pages except first (instructions)
 for page_num in range(1, len(doc)):
     page = doc[page_num]
-    text = page.get_text("text")
-
-    # Split into questions by number patterns
-    lines = text.split("\n")
-    for line in lines:
-        line_stripped = line.strip()
-        if line_stripped.startswith(tuple(str(i) for i in range(1, 26))):
-            problem_number += 1
-            problems.append({"ProblemNumber": problem_number, "Text": line_stripped, "Images": []})
-        elif problem_number > 0:
-            problems[-1]["Text"] += " " + line_stripped
+    carried = len(problems) - 1  # problem continuing from the previous page, if any
+
+    # Split into questions by number patterns, noting where each one starts
+    starts = []  # (top y of the numbered line, index into problems)
+    # Images are pulled by xref below, so don't copy their bytes into the dict too
+    for block in page.get_text("dict", flags=TEXT_FLAGS)["blocks"]:
+        for line in block.get("lines", []):
+            line_stripped = "".join(span["text"] for span in line["spans"]).strip()
+            m = PROBLEM_RE.match(line_stripped)
+            if m and 1 <= int(m.group(1)) <= 25:
+                problem_number += 1
+                problems.append({"ProblemNumber": problem_number, "Text": line_stripped, "Images": []})
+                starts.append((line["bbox"][1], len(problems) - 1))
+            elif problem_number > 0:
+                problems[-1]["Text"] += " " + line_stripped
+    starts.sort()
+    start_ys = [y for y, _ in starts]
 
     # Extract images
     images = page.get_images(full=True)
     for img_index, img in enumerate(images):
         xref = img[0]
+
+        # Owner is the problem whose number sits closest above the image centre
+        owner = len(problems) - 1
+        bbox = page.get_image_bbox(img)
+        if not (bbox.is_empty or bbox.is_infinite):
+            i = bisect.bisect_right(start_ys, (bbox.y0 + bbox.y1) / 2) - 1
+            owner = starts[i][1] if i >= 0 else carried
+        owner_number = problems[owner]["ProblemNumber"] if owner >= 0 else 0
+
         base_image = doc.extract_image(xref)
         image_bytes = base_image["image"]
         img_ext = base_image["ext"]
-        image = Image.open(io.BytesIO(image_bytes))
+        img_stem = f"{IMG_DIR}/q{owner_number}p{page_num+1}{img_index+1}"
+
+        # pdflatex reads png/jpeg directly, so keep those embedded streams as is
+        transcode = img_ext not in ("png", "jpg", "jpeg")
+        img_filename = f"{img_stem}.png" if transcode else f"{img_stem}.{img_ext}"
+        writes.append(io_pool.submit(save_image, img_filename, image_bytes, transcode))
 
-        img_filename = f"{IMG_DIR}/q{problem_number}p{page_num+1}{img_index+1}.{img_ext}"
-        image.save(img_filename)
+        if owner >= 0:
+            problems[owner]["Images"].append(img_filename)
 
-        # Attach to current problem (approximation: last active problem)
-        if problems:
-            problems[-1]["Images"].append(img_filename)
+io_pool.shutdown(wait=True)
+for w in writes:
+    w.result()  # surface any write error
 
 # Ensure exactly 25 problems
 problems = problems[:25]